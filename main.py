@@ -1,33 +1,89 @@
 from dotenv import load_dotenv
 import openai
 import time
+import hashlib
+import httpx
+import json
 import logging
+import mimetypes
+import mmap
+import os
+import re
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 
+logger = logging.getLogger(__name__)
+
 # manage the API secret key
 load_dotenv()
 openai.api_key = st.secrets["OPENAI_API_KEY"]
 
+# files above this size (in bytes) are uploaded in parts through the Uploads endpoint
+LARGE_FILE_SIZE = 100 * 1024 * 1024
+
+# persona and model of the Sea Level Rise Assistant (also used for offline batch questions)
+ASSISTANT_INSTRUCTIONS = (
+    "You are a neutral third-party with knowledge of key policy, grants, and studies related to sea level "
+    "rise in the City of Arcata in Humboldt County, California. Speak tersely. As much as possible, cite and "
+    "quote from documents to support your answers."
+)
+ASSISTANT_MODEL = "gpt-3.5-turbo-0125"
+
+# repeated questions are answered from a per-thread cache of earlier replies
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+REPLY_CACHE_SIZE = 128
+
+# words that make a message depend on the conversation before it ("tell me more", "why is that?");
+# such messages are never answered from the reply cache
+FOLLOW_UP_WORDS = {"it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "she",
+                   "more", "why", "else", "elaborate", "again", "above", "previous", "earlier"}
+
+# number of most recent chat messages displayed on each rerun; older ones are shown on request
+MAX_VISIBLE_MESSAGES = 50
+
 def upload_files(client, filepaths):
     """
     Uploads multiple documents to API files endpoint, returns an array of the file ids
     and prints a confirmation message with the # of files that were uploaded.
 
+    The uploads run concurrently on a thread pool, so the total time is roughly that of the slowest
+    upload rather than the sum of all of them. The order of the returned ids matches `filepaths`.
+    Each (non-empty) file is memory-mapped rather than read into memory, and closed once its upload is done.
+    Files larger than LARGE_FILE_SIZE are sent through the chunked Uploads endpoint instead, one file at
+    a time (each already uploads several parts at once), which bounds the memory held by part buffers.
+
     :param client: instance of the OpenAI API
     :param filepaths: array of the filepaths for the files to upload
     :return: file_ids: array of the file ids for the files that were uploaded
     """
 
-    file_ids = []
-    count = 0
-    for path in filepaths:
+    def upload(path):
+        with open(path, "rb") as f:
+            # an empty file can't be memory-mapped, so it is sent as is
+            if not os.path.getsize(path):
+                return create(path, f)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return create(path, mm)
+
+    def create(path, content):
         file = client.files.create(
-            file=open(path, "rb"),
+            file=(os.path.basename(path), content),
             purpose="assistants"
         )
-        file_ids.append(file.id)
-        count +=1
-    print(f"{count} file(s) uploaded")
+        return file.id
+
+    small_paths = [path for path in filepaths if os.path.getsize(path) <= LARGE_FILE_SIZE]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids_by_path = dict(zip(small_paths, executor.map(upload, small_paths)))
+    for path in filepaths:
+        if path not in ids_by_path:
+            ids_by_path[path] = upload_large_file(client, path)
+    file_ids = [ids_by_path[path] for path in filepaths]
+    print(f"{len(file_ids)} file(s) uploaded")
     return file_ids
 
 
@@ -46,24 +102,79 @@ def create_vector_store(client, vector_store_name):
     return vector_store.id
 
 
-def attach_file_to_vector_store(client, vector_store_id, file_ids):
+def upload_large_file(client, path, part_size=64 * 1024 * 1024):
     """
-    Attaches files to vector store. This is OpenAI API's way for the GPT to read the files.
-    Prints a confirmation with a count of hte number of files added to the vector store.
+    Uploads one large document through the API's chunked Uploads endpoint, which accepts files that are
+    too big for a single files.create request. The file is sent in parts of `part_size` bytes, up to
+    four at a time, and the upload is then completed into a regular file. An MD5 checksum is computed
+    while the parts are sent, so the API can verify the assembled file.
+
+    :param client: instance of the OpenAI API
+    :param path: string, filepath of the file to upload
+    :param part_size: int, size in bytes of each uploaded part (the API allows at most 64 MB per part)
+    :return: file_id: string, id of the file that was uploaded
+    """
+
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    upload = client.uploads.create(
+        bytes=os.path.getsize(path),
+        filename=os.path.basename(path),
+        mime_type=mime_type,
+        purpose="assistants"
+    )
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        def upload_part(start):
+            part = client.uploads.parts.create(upload_id=upload.id, data=mm[start:start + part_size])
+            return part.id
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            # map keeps the part ids in file order, which is the order the API assembles them in
+            part_ids = executor.map(upload_part, range(0, len(mm), part_size))
+            checksum = hashlib.md5(mm).hexdigest()
+            part_ids = list(part_ids)
+
+    upload = client.uploads.complete(upload_id=upload.id, part_ids=part_ids, md5=checksum)
+    return upload.file.id
 
-    :param client:  instance of the OpenAI API
+
+def ingest(client, vector_store_id, filepaths):
+    """
+    Uploads documents and attaches them to the vector store in one step. This is OpenAI API's way for
+    the GPT to read the files. Prints a confirmation with the number of files added to the vector store.
+
+    Files are uploaded concurrently and attached with a single file batch, then the batch is polled
+    until the vector store has finished processing them. Files larger than LARGE_FILE_SIZE are sent
+    through the chunked Uploads endpoint instead.
+
+    :param client: instance of the OpenAI API
     :param vector_store_id: string, id of the vector store
-    :param file_ids: array of strings, ids of the files
-    :return: None
+    :param filepaths: array of the filepaths for the files to upload
+    :return: batch: the vector store file batch, with the processing status of each file
     """
-    count = 0
-    for file_id in file_ids:
-        client.beta.vector_stores.files.create(
+
+    large_paths = [path for path in filepaths if os.path.getsize(path) > LARGE_FILE_SIZE]
+    large_file_ids = upload_files(client, large_paths) if large_paths else []
+
+    streams = []
+    try:
+        for path in filepaths:
+            if path not in large_paths:
+                streams.append(open(path, "rb"))
+        batch = client.beta.vector_stores.file_batches.upload_and_poll(
             vector_store_id=vector_store_id,
-            file_id=file_id
+            files=streams,
+            file_ids=large_file_ids
         )
-        count += 1
-    print(f"{count} file(s) added to vector store")
+    finally:
+        for stream in streams:
+            stream.close()
+
+    print(f"{batch.file_counts.completed} file(s) added to vector store")
+    if batch.file_counts.failed:
+        print(f"{batch.file_counts.failed} file(s) could not be processed by the vector store")
+    return batch
 
 
 def create_assistant(client, assistant_name, instructions, vector_store_id, model):
@@ -147,16 +258,41 @@ def create_run(client, thread_id, assistant_id):
     return run.id
 
 
-def retrieve_assistant_response(client, thread_id, run_id):
+def backoff_intervals(initial, factor, max_interval):
+    """
+    Yields the waits between polls of a long-running job: starts at `initial` seconds and grows by
+    `factor` after each poll, up to `max_interval`.
+
+    :param initial: float, seconds to wait before the first poll
+    :param factor: float, multiplier applied to the wait after each poll
+    :param max_interval: float, upper bound in seconds on the wait between polls
+    :return: generator of floats, the successive waits in seconds
+    """
+
+    current = initial
+    while True:
+        yield current
+        current = min(current * factor, max_interval)
+
+
+def retrieve_assistant_response(client, thread_id, run_id, initial=0.3, factor=1.5, max_interval=5.0):
     """
     Waits for a run to complete and prints the elapsed time and the assistant's message.
 
+    The run is polled with exponential backoff: the first waits are short so fast runs return quickly,
+    and the wait grows by `factor` after each check (up to `max_interval`) so long runs don't issue a
+    request every fraction of a second.
+
     :param client: instance of the OpenAI API
     :param thread_id: string, id of the current thread
     :param run_id: string, id of the latest run
+    :param initial: float, seconds to wait before the first poll
+    :param factor: float, multiplier applied to the wait after each poll
+    :param max_interval: float, upper bound in seconds on the wait between polls
     :return: response: string, content of the AI Assistant's response.
     """
 
+    intervals = backoff_intervals(initial, factor, max_interval)
     while True:
         try:
             run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
@@ -165,46 +301,394 @@ def retrieve_assistant_response(client, thread_id, run_id):
                 formatted_elapsed_time = time.strftime(
                     "%H:%M:%S", time.gmtime(elapsed_time)
                 )
-                logging.info(f"Run completed in {formatted_elapsed_time}")
+                logger.info("Run completed in %s", formatted_elapsed_time)
                 # Get messages once run is complete
                 messages = client.beta.threads.messages.list(thread_id=thread_id)
                 last_message = messages.data[0]
                 response = last_message.content[0].text.value
                 return response
         except Exception as e:
-            logging.error(f"An error occurred while retrieving the run: {e}")
+            logger.error("An error occurred while retrieving the run: %s", e)
             break
-        logging.info("Waiting for run to complete...")
-        time.sleep(5)
+        logger.info("Waiting for run to complete...")
+        time.sleep(next(intervals))
+
+
+def create_run_stream(client, thread_id, assistant_id, message, earlier_messages=()):
+    """
+    Appends the user message to the thread and creates a run whose events are streamed back, so the
+    Assistant's response can be shown as it is generated instead of waiting for the run to complete and
+    then fetching the message. Use the returned stream as a context manager and pass it to
+    reply_text_deltas to get the text of the response.
+
+    The user message is sent with the run request, so one request does the work of
+    add_user_message_to_thread and create_run. If there is no thread yet, the thread is created in that
+    same request too; its id is sent in the stream's `thread.run.created` event.
+
+    :param client: instance of the OpenAI API
+    :param thread_id: string, id of the thread, which is one conversation session between Assistant and user,
+                      or None to start a new thread
+    :param assistant_id: string, id of the Assistant whose response is desired
+    :param message: string, the content of the user's prompt or message
+    :param earlier_messages: array of {"role": string, "content": string} dictionaries, turns shown in the
+                             chat but not yet added to the thread (answered from the reply cache); they are
+                             sent with the run, before the user message
+    :return: stream manager for the run's events
+    """
+
+    messages = [*earlier_messages, {"role": "user", "content": message}]
+    if thread_id is None:
+        return client.beta.threads.create_and_run_stream(
+            assistant_id=assistant_id,
+            thread={"messages": messages},
+        )
+    return client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        additional_messages=messages,
+    )
+
+
+def run_status_note(run):
+    """
+    Explains why a run ended without completing, to be shown after whatever part of the response was
+    generated, so the user isn't left with an empty or cut-off reply and no notice.
+
+    :param run: the run object, with a status other than completed
+    :return: note: string, markdown explanation
+    """
+
+    if run.status == "failed":
+        note = f"Sorry, I couldn't answer that: {run.last_error.message if run.last_error else 'the run failed'}"
+    elif run.status == "incomplete":
+        details = run.incomplete_details
+        note = f"Response incomplete: {details.reason if details else 'unknown reason'}"
+    elif run.status == "cancelled":
+        note = "The response was cancelled"
+    elif run.status == "expired":
+        note = "The response timed out"
+    else:
+        note = f"The response did not complete (the run is {run.status.replace('_', ' ')})"
+    return f"\n\n*({note}.)*"
+
+
+def reply_text_deltas(stream, received):
+    """
+    Goes through the events of a run stream and yields the text of the Assistant's response as each
+    `thread.message.delta` event arrives, so it can be passed straight to st.write_stream.
+
+    The thread id is saved to the session (and the page's URL) as soon as the run is created, so it is
+    kept even if the user interrupts the reply, along with the run's id (see finish_interrupted_turn).
+    The yielded text is also collected in `received`, so the part of a reply that arrived before an error
+    can be kept.
+    The run also added any turns answered from the reply
+    cache to the thread, so they are cleared from st.session_state.unsynced. If the run fails or stops early, an explanation is
+    yielded instead of leaving the reply empty or cut off without notice.
+
+    :param stream: run stream returned by create_run_stream, entered as a context manager
+    :param received: array that the yielded pieces of text are appended to
+    :return: generator of strings, the pieces of the AI Assistant's response in order
+    """
+
+    for event in stream:
+        if event.event == "thread.run.created":
+            st.session_state.thread = event.data.thread_id
+            st.query_params["tid"] = event.data.thread_id
+            st.session_state.unsynced = []
+            st.session_state.pending_run = event.data.id
+        elif event.event == "thread.message.delta":
+            for part in event.data.delta.content or []:
+                if part.type == "text" and part.text and part.text.value:
+                    received.append(part.text.value)
+                    yield part.text.value
+        elif event.event in ("thread.run.failed", "thread.run.incomplete", "thread.run.cancelled",
+                             "thread.run.expired"):
+            note = run_status_note(event.data)
+            received.append(note)
+            yield note
+
+
+def wait_for_run_reply(client, thread_id, run_id):
+    """
+    Waits for a run that was started earlier (e.g. by a chat turn the user interrupted) to finish, and
+    returns the text of the messages it added to the thread. The run is polled with exponential backoff.
+
+    :param client: instance of the OpenAI API
+    :param thread_id: string, id of the thread, which is one conversation session between Assistant and user
+    :param run_id: string, id of the run
+    :return: reply: string, content of the AI Assistant's response, with a note if the run didn't complete
+    """
+
+    intervals = backoff_intervals(0.3, 1.5, 5.0)
+    run = client.beta.threads.runs.retrieve(run_id, thread_id=thread_id)
+    while run.status in ("queued", "in_progress", "cancelling"):
+        time.sleep(next(intervals))
+        run = client.beta.threads.runs.retrieve(run_id, thread_id=thread_id)
+
+    messages = client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, order="asc")
+    reply = "".join(part.text.value for message in messages for part in message.content if part.type == "text")
+    if run.status != "completed":
+        reply += run_status_note(run)
+    return reply
+
+
+def finish_interrupted_turn(client, message):
+    """
+    Finishes a chat turn that was interrupted before its reply was added to the chat history, which
+    happens when a new submit (e.g. hitting Enter twice) reruns the app while a reply is streaming.
+    If the turn's run had started, it keeps going on the server, so this waits for it and shows its reply:
+    nothing is lost, and the thread has no active run left that would block the next message. If the run
+    had not started, the unanswered message is removed from the history so it can be sent again.
+
+    :param client: instance of the OpenAI API
+    :param message: string, the normalized message that was just submitted
+    :return: boolean, True if the interrupted turn was for the same message and now has its reply
+    """
+
+    same_message = st.session_state.pending == message
+    run_id = st.session_state.pending_run
+    st.session_state.pending = st.session_state.pending_run = None
+    if run_id is None:
+        st.session_state.messages.pop()
+        return False
+
+    with st.chat_message("assistant"):
+        try:
+            with st.spinner("Finishing the previous response..."):
+                reply = wait_for_run_reply(client, st.session_state.thread, run_id)
+        except openai.APIError as e:
+            logger.error("An error occurred while retrieving the interrupted run: %s", e)
+            reply = "*(The response to this message could not be retrieved.)*"
+        st.markdown(reply)
+    st.session_state.messages.append({"role": "assistant", "content": reply})
+    load_thread_messages.clear(client, st.session_state.thread)
+    return same_message
+
+
+def normalize_message(message):
+    """
+    Lowercases a message and collapses its whitespace, so trivially different versions of the same
+    question map to the same reply cache key.
+
+    :param message: string, the content of the user's prompt or message
+    :return: string, the normalized message
+    """
+
+    return " ".join(message.split()).lower()
+
+
+def is_follow_up(message):
+    """
+    Tells whether a message obviously depends on the conversation before it (it is very short, or refers
+    back with words like "it", "that" or "more"), in which case an earlier reply to the same words may not
+    fit, so the reply cache isn't used for it.
+
+    :param message: string, the normalized user message
+    :return: boolean, True for a follow-up message
+    """
+
+    words = re.findall(r"[a-z']+", message)
+    return len(words) < 3 or any(word in FOLLOW_UP_WORDS for word in words)
+
+
+def embed_message(client, message):
+    """
+    Embeds a message for the reply cache's similarity search. The embedding is only an optimization, so
+    a failed request is logged and treated as a cache miss instead of failing the user's turn.
+
+    :param client: instance of the OpenAI API
+    :param message: string, the normalized user message
+    :return: embedding: numpy array (of length 1), or None if the request failed
+    """
+
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=message)
+    except openai.APIError as e:
+        logger.warning("Could not embed the message for the reply cache: %s", e)
+        return None
+    return np.array(response.data[0].embedding)
+
+
+def find_cached_reply(client, reply_cache, message):
+    """
+    Looks for an earlier reply to the same question in the reply cache. An exact match on the normalized
+    message is checked first; otherwise, if any cached question has an embedding, the message is embedded
+    and compared (by cosine similarity) with them, and the closest one is used if it is above
+    SIMILARITY_THRESHOLD. Nothing is embedded when there is nothing to compare with.
+
+    :param client: instance of the OpenAI API
+    :param reply_cache: OrderedDict of normalized message -> (embedding or None, reply), oldest first
+    :param message: string, the normalized user message
+    :return: (reply, embedding): reply is the cached reply string or None, embedding is the message's
+             embedding if one was computed (so it can be stored with the new reply), otherwise None
+    """
+
+    if message in reply_cache:
+        reply_cache.move_to_end(message)
+        return reply_cache[message][1], None
+
+    keys = [key for key, (embedding, _) in reply_cache.items() if embedding is not None]
+    if not keys:
+        return None, None
+    embedding = embed_message(client, message)
+    if embedding is None:
+        return None, None
+
+    # OpenAI embeddings are normalized to length 1, so the dot product is the cosine similarity
+    similarities = np.vstack([reply_cache[key][0] for key in keys]) @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] > SIMILARITY_THRESHOLD:
+        reply_cache.move_to_end(keys[best])
+        return reply_cache[keys[best]][1], embedding
+    return None, embedding
+
+
+def cache_reply(client, reply_cache, message, embedding, reply):
+    """
+    Stores a reply in the reply cache, evicting the least recently used entry once the cache holds more
+    than REPLY_CACHE_SIZE replies. A message that wasn't embedded during the lookup (the cache had nothing
+    to compare it with) is embedded now, after its reply has been shown, so later questions can match it.
+
+    :param client: instance of the OpenAI API
+    :param reply_cache: OrderedDict of normalized message -> (embedding or None, reply), oldest first
+    :param message: string, the normalized user message
+    :param embedding: numpy array, embedding of the normalized user message, or None
+    :param reply: string, content of the AI Assistant's response
+    :return: None
+    """
+
+    if embedding is None:
+        embedding = embed_message(client, message)
+    reply_cache[message] = (embedding, reply)
+    if len(reply_cache) > REPLY_CACHE_SIZE:
+        reply_cache.popitem(last=False)
+
+
+@st.cache_data(ttl=300)
+def load_thread_messages(_client, thread_id):
+    """
+    Loads the messages already in a thread, oldest first, so the chat history can be shown again after
+    the page is reloaded. Results are cached for five minutes.
+
+    :param _client: instance of the OpenAI API (the leading underscore tells Streamlit not to hash it)
+    :param thread_id: string, id of the thread, which is one conversation session between Assistant and user
+    :return: messages: array of {"role": string, "content": string} dictionaries, in the format of
+             st.session_state.messages
+    """
+
+    messages = []
+    for message in _client.beta.threads.messages.list(thread_id=thread_id, order="asc", limit=100):
+        content = "".join(part.text.value for part in message.content if part.type == "text")
+        messages.append({"role": message.role, "content": content})
+    return messages
+
+
+def batch_ask(client, questions, model=ASSISTANT_MODEL, instructions=ASSISTANT_INSTRUCTIONS):
+    """
+    Answers many independent questions offline with the Batch API, which costs half as much as
+    individual requests and doesn't count against the regular rate limits, in exchange for returning
+    results within 24 hours instead of right away. Meant for non-interactive work such as evaluations.
+
+    Note: the Batch API doesn't support Assistants, so each question is sent as a chat completion with
+          the Assistant's instructions and model, but without the file search tool and vector store.
+
+    :param client: instance of the OpenAI API
+    :param questions: array of strings, the questions to answer
+    :param model: string, alias of the GPT model
+    :param instructions: string, system prompt sent with each question
+    :return: answers: array of strings in the same order as `questions` (None for a question whose
+             request failed)
+    """
+
+    batch_requests = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": instructions},
+                    {"role": "user", "content": question},
+                ],
+            },
+        })
+        for i, question in enumerate(questions)
+    ]
+    input_file = client.files.create(
+        file=("questions.jsonl", "\n".join(batch_requests).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Batch created with ID: {batch.id}")
+
+    # batches take minutes to hours, so polls start at 5 seconds and back off to every 5 minutes
+    intervals = backoff_intervals(5.0, 1.5, 300.0)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        logger.info("Waiting for batch to complete (%s)...", batch.status)
+        time.sleep(next(intervals))
+        batch = client.batches.retrieve(batch.id)
+
+    if not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}' and no results")
+
+    answers = [None] * len(questions)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        response = result.get("response")
+        if response and response["status_code"] == 200:
+            answers[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+    print(f"{sum(answer is not None for answer in answers)} of {len(questions)} question(s) answered")
+    return answers
+
+
+@st.cache_resource(show_spinner=False)
+def get_client():
+    """
+    Creates the OpenAI client once per server process. Streamlit reruns the whole script on every user
+    event, so caching the client keeps its HTTP connection pool (and open TLS connections) alive across
+    reruns instead of building a new one each time. The cache shows no spinner, because get_client is
+    called before st.set_page_config, which must be the first thing the app draws.
+
+    The client retries rate limit (429), server (5xx) and connection errors up to six times, waiting
+    with jittered exponential backoff, so a transient failure doesn't end the user's request. It speaks
+    HTTP/2, so concurrent requests (e.g. file uploads) share one connection instead of opening one each.
+
+    :return: client: instance of the OpenAI API
+    """
+
+    http_client = openai.DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+    return openai.OpenAI(max_retries=6, http_client=http_client)
 
 
 def main():
 
-    # Create an OpenAI client instance that uses the API key from environment variables
-    client = openai.OpenAI()
+    # Get the shared OpenAI client instance that uses the API key from environment variables
+    client = get_client()
 
     # =======================Code used one time to upload files to API endpoint and create Assistant==================
 
-    # 1. Upload files to the files endpoint and get file IDs
-    # filepaths = [os.path.join("documents", "City_of_Arcata_Sea_Level_Rise_Vulnerability_Assessment.pdf"),
-    #              os.path.join("documents", "City_of_Arcata_LCP_Update_DRAFT.pdf")]
-    # file_ids = upload_files(client, filepaths)
-
-    # 2. Create a vector store and get the vector store ID
+    # 1. Create a vector store and get the vector store ID
     # vector_store_id = create_vector_store(client, "Sea Level Rise Documents")
 
-    # 3. Attach the files to the vector store
-    # attach_file_to_vector_store(client, vector_store_id, file_ids)
+    # 2. Upload the files and attach them to the vector store
+    # filepaths = [os.path.join("documents", "City_of_Arcata_Sea_Level_Rise_Vulnerability_Assessment.pdf"),
+    #              os.path.join("documents", "City_of_Arcata_LCP_Update_DRAFT.pdf")]
+    # ingest(client, vector_store_id, filepaths)
 
-    # 4. Create an assistant and attach the vector store to the assistant
+    # 3. Create an assistant and attach the vector store to the assistant
     # assistant_id = create_assistant(client,
     #                                 "Sea Level Rise Arcata Assistant",
-    #                                 """You are a neutral third-party with knowledge of key policy, grants,
-    #                                 and studies related to sea level rise in the City of Arcata in Humboldt County,
-    #                                 California. Speak tersely. As much as possible, cite and quote from documents to
-    #                                 support your answers.""",
+    #                                 ASSISTANT_INSTRUCTIONS,
     #                                 vector_store_id,
-    #                                 "gpt-3.5-turbo-0125")
+    #                                 ASSISTANT_MODEL)
     assistant_id = 'asst_mmc1upNxaYhajQbTgKo0XwMr'
 
     # =======================Optional code: for chatting with assistant within the IDE==================
@@ -245,11 +729,55 @@ def main():
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
+    # reply caches, one OrderedDict per thread id
+    if "reply_caches" not in st.session_state:
+        st.session_state.reply_caches = {}
+
+    # turns answered from a reply cache that aren't in the thread yet; they are sent with the next run
+    if "unsynced" not in st.session_state:
+        st.session_state.unsynced = []
+
+    # normalized user message that is waiting for the Assistant's reply, if any, and the id of its run
+    # once the run has been created
+    if "pending" not in st.session_state:
+        st.session_state.pending = None
+        st.session_state.pending_run = None
+
+    # the thread id is kept in the page's URL (?tid=...), so reloading the page continues the same
+    # conversation instead of starting a new thread
+    # a new thread is created together with the first run, so it costs no extra request
+    # the thread is only adopted once its history has loaded, so a failed load is retried on the next rerun
     if "thread" not in st.session_state:
-        st.session_state.thread = create_thread(client)
+        thread_id = st.query_params.get("tid")
+        if thread_id:
+            try:
+                st.session_state.messages = load_thread_messages(client, thread_id)
+                st.session_state.thread = thread_id
+            except (openai.NotFoundError, openai.BadRequestError):
+                # the thread in the URL doesn't exist (anymore), so starts a new conversation
+                st.session_state.thread = None
+                del st.query_params["tid"]
+            except openai.APIError as e:
+                logger.error("An error occurred while loading the conversation: %s", e)
+                st.error("Sorry, this conversation couldn't be loaded right now.")
+                st.button("Try again")
+                st.stop()
+        else:
+            st.session_state.thread = None
 
     # displays chat messages from session state
-    for message in st.session_state.messages:
+    # only the latest MAX_VISIBLE_MESSAGES are redrawn on every rerun; older messages are drawn only
+    # when the user asks for them, so long chats don't slow down each interaction
+    hidden_count = max(len(st.session_state.messages) - MAX_VISIBLE_MESSAGES, 0)
+    # the toggle's arguments never change (Streamlit derives the widget's identity from all of them), so
+    # it stays on as new messages change the hidden count; the count is shown in a caption instead
+    if hidden_count and st.toggle("Show earlier messages", key="show_earlier"):
+        visible_messages = st.session_state.messages
+    else:
+        visible_messages = st.session_state.messages[hidden_count:]
+        if hidden_count:
+            st.caption(f"{hidden_count} earlier message(s) hidden")
+    for message in visible_messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
@@ -257,27 +785,96 @@ def main():
     user_message = st.chat_input("Hi! Ask me about sea level rise in Arcata, California.")
     # if the user's input is not empty
     if user_message:
-        # adds user message to session state
+        cache_key = normalize_message(user_message)
+
+        # if this submit interrupted a turn that was still being answered (e.g. Enter was hit twice),
+        # finishes that turn first; a repeat of the same message is answered by it and isn't sent again
+        if st.session_state.pending is not None and finish_interrupted_turn(client, cache_key):
+            st.stop()
+
+        # adds user message to session state and marks it as waiting for a reply
         st.session_state.messages.append({"role": "user", "content": user_message})
+        st.session_state.pending = cache_key
+        st.session_state.pending_run = None
         with st.chat_message("user"):
             st.markdown(user_message)
 
-        # sends user's message to OpenAI Assistant API
-        # a thread is OpenAI's way of keeping track of messages in one conversation
-        add_user_message_to_thread(client, st.session_state.thread, user_message)
+        try:
+            # answers repeated questions in this thread from its reply cache instead of running the
+            # Assistant again (follow-ups like "why?" depend on the conversation, so they always get a run)
+            reply_content = embedding = reply_cache = stream = None
+            received = []
+            if not is_follow_up(cache_key):
+                # a new thread starts with an empty cache, which is filed under its id once it exists
+                reply_cache = st.session_state.reply_caches.get(st.session_state.thread) or OrderedDict()
+                reply_content, embedding = find_cached_reply(client, reply_cache, cache_key)
+
+            with st.chat_message("assistant"):
+                if reply_content is not None:
+                    st.markdown(reply_content)
+                    # the turn is added to the thread with the next run, so it costs no request now
+                    st.session_state.unsynced += [{"role": "user", "content": user_message},
+                                                  {"role": "assistant", "content": reply_content}]
+                else:
+                    # sends user's message to OpenAI Assistant API with a run, and displays the Assistant's
+                    # response as it is streamed back
+                    # a thread is OpenAI's way of keeping track of messages in one conversation
+                    with create_run_stream(client, st.session_state.thread, assistant_id, user_message,
+                                           st.session_state.unsynced) as stream:
+                        reply_content = st.write_stream(reply_text_deltas(stream, received))
+                    # the thread has new messages, so a reload must not show its cached history
+                    load_thread_messages.clear(client, st.session_state.thread)
+                    if reply_cache is not None:
+                        st.session_state.reply_caches[st.session_state.thread] = reply_cache
+        except Exception as e:
+            run_created = st.session_state.pending_run is not None
+            if run_created:
+                # the thread already has the message (and the reply so far), so keeps both, with a note
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": "".join(received) + "\n\n*(The response was interrupted by an error.)*"
+                })
+            else:
+                # the message never reached the Assistant, so drops it and lets the user send it again
+                st.session_state.messages.pop()
+            st.session_state.pending = st.session_state.pending_run = None
+            if not isinstance(e, openai.APIError):
+                raise
+            logger.error("An error occurred while answering the message: %s", e)
+            st.error("Sorry, something went wrong while reaching the Assistant."
+                     + ("" if run_created else " Please send your message again."))
+        else:
+            # Add assistant response to session state
+            st.session_state.messages.append({"role": "assistant", "content": reply_content})
+            st.session_state.pending = st.session_state.pending_run = None
+
+            # only complete answers to standalone questions are reused for repeated questions
+            if (reply_cache is not None and stream is not None
+                    and stream.current_run and stream.current_run.status == "completed"):
+                cache_reply(client, reply_cache, cache_key, embedding, reply_content)
 
-        # create a run, which will produce Assistant's response
-        run_id = create_run(client, st.session_state.thread, assistant_id)
+    # Run app on http://localhost:8501/ with the terminal command: streamlit run main.py
 
-        # retrieve and store Assistant's response
-        reply_content = retrieve_assistant_response(client, st.session_state.thread, run_id)
+def batch_main(questions_path):
+    """
+    Command line entry point for batch questions: reads one question per line from a text file, answers
+    them with batch_ask and prints each question with its answer.
 
-        # Add assistant response to session state
-        st.session_state.messages.append({"role": "assistant", "content": reply_content})
-        with st.chat_message("assistant"):
-            st.markdown(reply_content)
+    :param questions_path: string, filepath of the text file with the questions
+    :return: None
+    """
+
+    with open(questions_path, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    answers = batch_ask(get_client(), questions)
+    for question, answer in zip(questions, answers):
+        print(f"Q: {question}\nA: {answer if answer is not None else '(request failed)'}\n")
 
-    # Run app on http://localhost:8501/ with the terminal command: streamlit run main.py
 
 if __name__ == '__main__':
-    main()
+    # Answer a file of questions offline with the terminal command: python main.py batch questions.txt
+    if len(sys.argv) == 3 and sys.argv[1] == "batch":
+        batch_main(sys.argv[2])
+    else:
+        main()